@@ -0,0 +1,19 @@
+"""
+Environment configuration for the Gmail MCP Server.
+
+The .env file is loaded once per process by the entrypoint rather than
+at import time by every module.
+"""
+
+from dotenv import load_dotenv
+
+_loaded = False
+
+
+def ensure_env() -> None:
+    """Load environment variables from .env the first time this is called."""
+    global _loaded
+    
+    if not _loaded:
+        load_dotenv()
+        _loaded = True
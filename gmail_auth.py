@@ -1,31 +1,150 @@
+import json
+import logging
 import os
+import time
+from functools import lru_cache
+from datetime import datetime, timedelta, timezone
 import requests
-from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from google.oauth2.credentials import Credentials
 from google.auth.transport.requests import Request
-from googleapiclient.discovery import build
-from typing import Dict, Any
+from googleapiclient.discovery import build, build_from_document
+from googleapiclient.discovery_cache import get_static_doc
+from typing import Dict, Any, Optional, Tuple
 
-# Load environment variables from .env file
-load_dotenv()
+from config import ensure_env
+
+logger = logging.getLogger("gmail_mcp")
 
 # Gmail API scope
 SCOPES = ['https://www.googleapis.com/auth/gmail.readonly']
 
+# Refresh cached credentials this many seconds before they expire. This must
+# exceed google-auth's REFRESH_THRESHOLD (225s): past that point Credentials
+# report themselves invalid and try to refresh, which fails without a client ID
+EXPIRY_MARGIN = 300
+
+# Assumed token lifetime when Nango does not report one
+DEFAULT_EXPIRES_IN = 3500
+
+# (connect, read) timeouts in seconds for Nango requests
+NANGO_TIMEOUT = (3, 10)
+
+# Shared HTTP session for Nango, created on first use
+_session: Optional[requests.Session] = None
+
+# (connection_id, provider_config_key) -> (nango_response, token expires_at)
+_cred_cache: Dict[Tuple[str, str], Tuple[Dict[str, Any], float]] = {}
+
+# (connection_id, provider_config_key) -> Gmail credentials
+_gmail_creds_cache: Dict[Tuple[str, str], Credentials] = {}
+
+
+def _utcnow() -> datetime:
+    """Current UTC time as a naive datetime, as used by google-auth"""
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def get_token_expires_at(nango_response: Dict[str, Any]) -> float:
+    """Get the access token expiry as a Unix timestamp from a Nango response"""
+    credentials_data = nango_response.get('credentials', {})
+    
+    # expires_at is absolute, while raw.expires_in is the lifetime at issue
+    # time and overstates what is left on a token Nango issued earlier
+    expires_at = credentials_data.get('expires_at') or nango_response.get('expires_at')
+    if expires_at:
+        try:
+            return datetime.fromisoformat(expires_at.replace('Z', '+00:00')).timestamp()
+        except (AttributeError, ValueError):
+            logger.warning("Could not parse Nango expires_at: %s", expires_at)
+    
+    for data in (nango_response, credentials_data, credentials_data.get('raw', {})):
+        if data.get('expires_in'):
+            return time.time() + int(data['expires_in'])
+    return time.time() + DEFAULT_EXPIRES_IN
+
+
+def get_token_expiry(expires_at: float) -> datetime:
+    """Convert a Unix expiry timestamp to the naive UTC datetime google-auth expects"""
+    return datetime.fromtimestamp(expires_at, timezone.utc).replace(tzinfo=None)
+
+
+def invalidate_credentials(connection_id: str, provider_config_key: str = "google") -> None:
+    """Forget cached credentials, e.g. after Gmail rejects the access token"""
+    cache_key = (connection_id, provider_config_key)
+    _cred_cache.pop(cache_key, None)
+    _gmail_creds_cache.pop(cache_key, None)
+
+
+@lru_cache(maxsize=None)
+def get_variable(name: str) -> str:
+    """Get a required environment variable, read once per process"""
+    ensure_env()
+    value = os.environ.get(name)
+    if not value:
+        raise ValueError(f"{name} environment variable is required")
+    return value
+
+
+@lru_cache(maxsize=None)
+def load_gmail_discovery() -> Optional[Dict[str, Any]]:
+    """Load and parse the Gmail discovery document bundled with googleapiclient"""
+    document = get_static_doc('gmail', 'v1')
+    return json.loads(document) if document else None
+
+
+def build_gmail_service(creds: Credentials) -> Any:
+    """Build a Gmail service from the memoized discovery document"""
+    discovery = load_gmail_discovery()
+    if discovery is None:
+        # Fetch the document without probing the on-disk discovery cache
+        return build('gmail', 'v1', credentials=creds, cache_discovery=False, static_discovery=False)
+    return build_from_document(discovery, credentials=creds)
+
+
+def get_nango_session() -> requests.Session:
+    """Get the pooled keep-alive session used for Nango requests"""
+    global _session
+    
+    if _session is None:
+        session = requests.Session()
+        retries = Retry(total=3, backoff_factor=0.2, status_forcelist=[502, 503, 504])
+        session.mount("https://", HTTPAdapter(pool_connections=8, pool_maxsize=16, max_retries=retries))
+        session.headers["Authorization"] = f"Bearer {get_variable('NANGO_SECRET_KEY')}"
+        _session = session
+    
+    return _session
+
 
 def get_connection_credentials(id: str, providerConfigKey: str) -> Dict[str, Any]:
-    """Get credentials from Nango"""
-    base_url = os.environ.get("NANGO_BASE_URL")
-    secret_key = os.environ.get("NANGO_SECRET_KEY")
+    """Get credentials from Nango, reusing them until shortly before expiry"""
+    return get_connection_credentials_with_expiry(id, providerConfigKey)[0]
+
+def get_connection_credentials_with_expiry(id: str, providerConfigKey: str) -> Tuple[Dict[str, Any], float]:
+    """Get credentials from Nango along with the token's expiry timestamp"""
+    cache_key = (id, providerConfigKey)
+    cached = _cred_cache.get(cache_key)
+    if cached and cached[1] - EXPIRY_MARGIN > time.time():
+        return cached
+    
+    nango_response = fetch_connection_credentials(id, providerConfigKey)
+    cached = (nango_response, get_token_expires_at(nango_response))
+    _cred_cache[cache_key] = cached
+    
+    return cached
+
+def fetch_connection_credentials(id: str, providerConfigKey: str) -> Dict[str, Any]:
+    """Fetch credentials from Nango"""
+    base_url = get_variable("NANGO_BASE_URL")
     
     url = f"{base_url}/connection/{id}"
     params = {
         "provider_config_key": providerConfigKey,
         "refresh_token": "true",
     }
-    headers = {"Authorization": f"Bearer {secret_key}"}
     
-    response = requests.get(url, headers=headers, params=params)
+    response = get_nango_session().get(url, params=params, timeout=NANGO_TIMEOUT)
     response.raise_for_status()  # Raise exception for bad status codes
     
     return response.json()
@@ -64,7 +183,7 @@ def authenticate_gmail_with_nango(connection_id: str, provider_config_key: str =
     
     try:
         # Get credentials from Nango
-        print(f"Getting credentials for connection: {connection_id}")
+        logger.debug("Getting credentials for connection: %s", connection_id)
         nango_response = get_connection_credentials(connection_id, provider_config_key)
         
         # Create Google credentials from Nango response
@@ -72,32 +191,46 @@ def authenticate_gmail_with_nango(connection_id: str, provider_config_key: str =
         
         # Refresh token if needed
         if not creds.valid and creds.refresh_token:
-            print("Refreshing access token...")
+            logger.debug("Refreshing access token...")
             creds.refresh(Request())
         
         # Build the Gmail service
-        service = build('gmail', 'v1', credentials=creds)
-        print("Gmail API authenticated successfully with Nango!")
+        service = build_gmail_service(creds)
+        logger.debug("Gmail API authenticated successfully with Nango!")
         
         return service
         
     except requests.exceptions.RequestException as e:
-        print(f"Error connecting to Nango: {e}")
+        logger.error("Error connecting to Nango: %s", e)
         raise
     except Exception as e:
-        print(f"Error authenticating with Gmail: {e}")
+        logger.error("Error authenticating with Gmail: %s", e)
         raise
 
 # Alternative version if Nango response structure is different
 def authenticate_gmail_with_nango_v2(connection_id: str, provider_config_key: str = "google") -> build:
     """Alternative version - adjust based on your Nango response structure"""
     
+    service = build_gmail_service(get_gmail_credentials(connection_id, provider_config_key))
+    logger.debug("Gmail API authenticated successfully with Nango!")
+    
+    return service
+
+def get_gmail_credentials(connection_id: str, provider_config_key: str = "google") -> Credentials:
+    """Get Gmail credentials from Nango, reusing them until shortly before expiry"""
+    
+    cache_key = (connection_id, provider_config_key)
+    cached = _gmail_creds_cache.get(cache_key)
+    if cached and cached.expiry and cached.expiry > _utcnow() + timedelta(seconds=EXPIRY_MARGIN):
+        return cached
+    
+    nango_response = None
     try:
         # Get credentials from Nango
-        nango_response = get_connection_credentials(connection_id, provider_config_key)
+        nango_response, expires_at = get_connection_credentials_with_expiry(connection_id, provider_config_key)
         
         # Debug: Print response structure (remove in production)
-        print("Nango response structure:", list(nango_response.keys()))
+        logger.debug("Nango response structure: %s", list(nango_response))
         
         # Try different response structures
         access_token = None
@@ -118,7 +251,7 @@ def authenticate_gmail_with_nango_v2(connection_id: str, provider_config_key: st
         if not access_token:
             raise ValueError(f"No access token found in Nango response. Available keys: {list(nango_response.keys())}")
         
-        print(f"Found access token: {access_token[:20]}...")
+        logger.debug("Found access token: %s...", access_token[:20])
         
         # Create OAuth2 credentials
         creds = Credentials(
@@ -127,22 +260,19 @@ def authenticate_gmail_with_nango_v2(connection_id: str, provider_config_key: st
             token_uri='https://oauth2.googleapis.com/token',
             client_id=None,  # Not required for existing tokens
             client_secret=None,  # Not required for existing tokens
-            scopes=SCOPES
+            scopes=SCOPES,
+            expiry=get_token_expiry(expires_at)
         )
         
-        # Build the Gmail service
-        service = build('gmail', 'v1', credentials=creds)
-        print("Gmail API authenticated successfully with Nango!")
+        _gmail_creds_cache[cache_key] = creds
         
-        return service
+        return creds
         
-    except Exception as e:
-        print(f"Error in authentication: {e}")
-        print("Full Nango response for debugging:")
-        try:
-            nango_response = get_connection_credentials(connection_id, provider_config_key)
-            print(nango_response)
-        except:
-            print("Could not fetch Nango response for debugging")
+    except Exception:
+        logger.exception("Error in authentication")
+        logger.debug(
+            "Full Nango response for debugging: %s",
+            nango_response if nango_response is not None else "<no response>"
+        )
         raise
 
@@ -1,76 +1,216 @@
 import base64
+import logging
+from collections import deque
 from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-from email.mime.base import MIMEBase
-from email import encoders
+from email.generator import BytesGenerator
+from email.message import EmailMessage
+from email.policy import SMTP
+from io import BytesIO
+from itertools import islice
+import mmap
 import os
-from dotenv import load_dotenv
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import httplib2
+from google.auth.exceptions import RefreshError
+from google_auth_httplib2 import AuthorizedHttp
+from googleapiclient.errors import HttpError
+from googleapiclient.http import MediaIoBaseUpload
 
-# Load environment variables
-load_dotenv()
+logger = logging.getLogger("gmail_mcp")
+
+# Headers shown in message list and search views
+SUMMARY_HEADERS = ['From', 'Subject', 'Date']
+
+# Partial response for message list and search views
+SUMMARY_FIELDS = 'id,threadId,labelIds,snippet,payload/headers'
+
+# Largest page Gmail returns from messages.list
+MAX_PAGE_SIZE = 500
+
+# Search views also need the content type to detect attachments
+SEARCH_HEADERS = SUMMARY_HEADERS + ['Content-Type']
+
+# Gmail accepts at most 100 calls in a single batch request
+BATCH_SIZE = 100
+
+# Concurrent requests used when batching fails, kept well under Gmail's
+# per-user rate limit
+MAX_WORKERS = 8
+
+# Messages larger than this are sent with a resumable media upload
+MEDIA_UPLOAD_THRESHOLD = 5 * 1024 * 1024
+MEDIA_CHUNK_SIZE = 1024 * 1024
+
+# batchModify and batchDelete accept at most 1000 message IDs per call
+BULK_SIZE = 1000
+
+def extract_text_from_payload(payload):
+    """Return the first text/plain body found in a message payload"""
+    stack = deque([payload])
+    while stack:
+        part = stack.pop()
+        data = part.get('body', {}).get('data')
+        if part.get('mimeType') == 'text/plain' and data:
+            return base64.urlsafe_b64decode(data).decode('utf-8', errors='replace')
+        # Visit nested parts in document order
+        stack.extend(reversed(part.get('parts', [])))
+    return ""
+
+def add_file_attachment(message, file_path):
+    """Attach a file to an EmailMessage, memory-mapping its contents"""
+    filename = os.path.basename(file_path)
+    with open(file_path, "rb") as attachment:
+        if os.fstat(attachment.fileno()).st_size == 0:
+            message.add_attachment(b'', maintype='application', subtype='octet-stream', filename=filename)
+            return
+        
+        with mmap.mmap(attachment.fileno(), 0, access=mmap.ACCESS_READ) as mapped, memoryview(mapped) as data:
+            message.add_attachment(data, maintype='application', subtype='octet-stream', filename=filename)
+
+def is_auth_error(error):
+    """Check whether an error means Gmail rejected the access token"""
+    if isinstance(error, RefreshError):
+        return True
+    return isinstance(error, HttpError) and error.resp.status == 401
 
 class GmailClient:
-    def __init__(self, service):
+    def __init__(self, service, credentials=None, on_auth_error=None):
         self.service = service
+        self.credentials = credentials
+        self.on_auth_error = on_auth_error
+    
+    def check_auth_error(self, error):
+        """Notify the owner when an error means the credentials are no longer valid"""
+        if self.on_auth_error is not None and is_auth_error(error):
+            self.on_auth_error()
+    
+    def iter_messages(self, query='', page_size=100):
+        """Yield messages matching query, fetching one page at a time"""
+        messages_api = self.service.users().messages()
+        request = messages_api.list(
+            userId='me', 
+            q=query, 
+            maxResults=page_size,
+            fields='messages/id,nextPageToken'
+        )
+        while request is not None:
+            result = request.execute()
+            yield from result.get('messages', [])
+            request = messages_api.list_next(request, result)
     
     def list_messages(self, query='', max_results=10):
         """List messages matching query"""
         try:
-            result = self.service.users().messages().list(
-                userId='me', 
-                q=query, 
-                maxResults=max_results
-            ).execute()
-            
-            messages = result.get('messages', [])
-            return messages
+            page_size = min(max_results, MAX_PAGE_SIZE)
+            return list(islice(self.iter_messages(query, page_size), max_results))
         except Exception as e:
-            print(f'Error listing messages: {e}')
+            self.check_auth_error(e)
+            logger.error('Error listing messages: %s', e)
             return []
     
-    def get_message(self, message_id):
+    def _get_message_request(self, message_id, format='full', metadata_headers=None, fields=None):
+        """Build a messages.get request, limiting headers for metadata views"""
+        params = {'userId': 'me', 'id': message_id, 'format': format}
+        if format == 'metadata' and metadata_headers:
+            params['metadataHeaders'] = metadata_headers
+        if fields:
+            params['fields'] = fields
+        return self.service.users().messages().get(**params)
+    
+    def get_message(self, message_id, format='full', metadata_headers=None, fields=None):
         """Get a specific message by ID"""
         try:
-            message = self.service.users().messages().get(
-                userId='me', 
-                id=message_id,
-                format='full'
+            message = self._get_message_request(
+                message_id,
+                format=format,
+                metadata_headers=metadata_headers,
+                fields=fields
             ).execute()
             return message
         except Exception as e:
-            print(f'Error getting message: {e}')
+            self.check_auth_error(e)
+            logger.error('Error getting message: %s', e)
             return None
     
+    def batch_get_messages(self, message_ids, format='metadata', metadata_headers=None, fields=None):
+        """Get several messages using batch requests, keyed by message ID"""
+        if metadata_headers is None:
+            metadata_headers = SUMMARY_HEADERS
+        
+        messages = {}
+        
+        def store_message(request_id, response, exception):
+            if exception is not None:
+                self.check_auth_error(exception)
+                logger.error('Error getting message %s: %s', request_id, exception)
+            else:
+                messages[request_id] = response
+        
+        # Batch request IDs must be unique
+        message_ids = list(dict.fromkeys(message_ids))
+        for start in range(0, len(message_ids), BATCH_SIZE):
+            batch = self.service.new_batch_http_request(callback=store_message)
+            for message_id in message_ids[start:start + BATCH_SIZE]:
+                batch.add(
+                    self._get_message_request(message_id, format, metadata_headers, fields),
+                    request_id=message_id
+                )
+            try:
+                batch.execute()
+            except Exception as e:
+                self.check_auth_error(e)
+                logger.warning('Error executing batch request, fetching concurrently: %s', e)
+                messages.update(self._parallel_get(
+                    message_ids[start:start + BATCH_SIZE],
+                    format, metadata_headers, fields
+                ))
+        
+        return messages
+    
+    def _parallel_get(self, message_ids, format='full', metadata_headers=None, fields=None, max_workers=MAX_WORKERS):
+        """Get messages concurrently, keyed by message ID"""
+        if self.credentials is None:
+            # Without credentials there is no way to open per-thread
+            # connections, so fetch one at a time over the shared service
+            fetched = {
+                message_id: self.get_message(message_id, format, metadata_headers, fields)
+                for message_id in message_ids
+            }
+            return {message_id: message for message_id, message in fetched.items() if message}
+        
+        # The shared httplib2 connection is not thread-safe, so each
+        # worker executes its requests over its own authorized connection
+        local = threading.local()
+        message_requests = [
+            self._get_message_request(message_id, format, metadata_headers, fields)
+            for message_id in message_ids
+        ]
+        
+        def execute(request):
+            if not hasattr(local, 'http'):
+                local.http = AuthorizedHttp(self.credentials, http=httplib2.Http())
+            try:
+                return request.execute(http=local.http)
+            except Exception as e:
+                self.check_auth_error(e)
+                logger.error('Error getting message: %s', e)
+                return None
+        
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = executor.map(execute, message_requests)
+            return {
+                message_id: message
+                for message_id, message in zip(message_ids, results)
+                if message
+            }
+    
     def get_message_body(self, message):
         """Extract body from message"""
         if not message or 'payload' not in message:
             return ""
-            
-        payload = message['payload']
-        body = ""
-        
-        def extract_text_from_payload(payload):
-            body_text = ""
-            
-            if 'parts' in payload:
-                for part in payload['parts']:
-                    if part['mimeType'] == 'text/plain' and 'data' in part.get('body', {}):
-                        data = part['body']['data']
-                        body_text = base64.urlsafe_b64decode(data).decode('utf-8')
-                        break
-                    # Handle nested parts
-                    elif 'parts' in part:
-                        body_text = extract_text_from_payload(part)
-                        if body_text:
-                            break
-            else:
-                if payload['mimeType'] == 'text/plain' and 'data' in payload.get('body', {}):
-                    data = payload['body']['data']
-                    body_text = base64.urlsafe_b64decode(data).decode('utf-8')
-            
-            return body_text
         
-        return extract_text_from_payload(payload)
+        return extract_text_from_payload(message['payload'])
     
     def get_message_headers(self, message):
         """Extract headers from message"""
@@ -82,6 +222,16 @@ class GmailClient:
             headers[header['name']] = header['value']
         return headers
     
+    def message_has_attachment(self, message, headers=None):
+        """Check whether a message carries attachments, judged by its top-level content type"""
+        if not message or 'payload' not in message:
+            return False
+        
+        # Metadata views carry no MIME parts, so rely on the multipart/mixed header
+        if headers is None:
+            headers = self.get_message_headers(message)
+        return headers.get('Content-Type', '').lower().startswith('multipart/mixed')
+    
     def send_message(self, to, subject, body, from_email=None):
         """Send an email message"""
         try:
@@ -100,53 +250,64 @@ class GmailClient:
                 body={'raw': raw_message}
             ).execute()
             
-            print(f'Message sent. Message ID: {send_message["id"]}')
+            logger.debug('Message sent. Message ID: %s', send_message['id'])
             return send_message
             
         except Exception as e:
-            print(f'Error sending message: {e}')
+            self.check_auth_error(e)
+            logger.error('Error sending message: %s', e)
             return None
     
     def send_message_with_attachment(self, to, subject, body, file_path):
         """Send email with attachment"""
         try:
-            message = MIMEMultipart()
+            message = EmailMessage()
             message['to'] = to
             message['subject'] = subject
             
             # Add body
-            message.attach(MIMEText(body, 'plain'))
+            message.set_content(body)
             
             # Add attachment
             if os.path.exists(file_path):
-                with open(file_path, "rb") as attachment:
-                    part = MIMEBase('application', 'octet-stream')
-                    part.set_payload(attachment.read())
-                
-                encoders.encode_base64(part)
-                part.add_header(
-                    'Content-Disposition',
-                    f'attachment; filename= {os.path.basename(file_path)}'
-                )
-                message.attach(part)
+                add_file_attachment(message, file_path)
             else:
-                print(f"Warning: Attachment file {file_path} not found")
+                logger.warning("Attachment file %s not found", file_path)
                 return None
             
-            raw_message = base64.urlsafe_b64encode(
-                message.as_bytes()
-            ).decode()
+            # Serialize once into a buffer that is either uploaded as-is
+            # or base64-encoded without an intermediate bytes copy
+            buffer = BytesIO()
+            BytesGenerator(buffer, policy=SMTP).flatten(message)
             
-            send_message = self.service.users().messages().send(
-                userId='me',
-                body={'raw': raw_message}
-            ).execute()
+            if buffer.tell() > MEDIA_UPLOAD_THRESHOLD:
+                buffer.seek(0)
+                media = MediaIoBaseUpload(
+                    buffer,
+                    mimetype='message/rfc822',
+                    chunksize=MEDIA_CHUNK_SIZE,
+                    resumable=True
+                )
+                send_message = self.service.users().messages().send(
+                    userId='me',
+                    body={},
+                    media_body=media
+                ).execute()
+            else:
+                with buffer.getbuffer() as data:
+                    raw_message = base64.urlsafe_b64encode(data).decode('ascii')
+                
+                send_message = self.service.users().messages().send(
+                    userId='me',
+                    body={'raw': raw_message}
+                ).execute()
             
-            print(f'Message with attachment sent. Message ID: {send_message["id"]}')
+            logger.debug('Message with attachment sent. Message ID: %s', send_message['id'])
             return send_message
             
         except Exception as e:
-            print(f'Error sending message with attachment: {e}')
+            self.check_auth_error(e)
+            logger.error('Error sending message with attachment: %s', e)
             return None
     
     def mark_as_read(self, message_id):
@@ -157,12 +318,30 @@ class GmailClient:
                 id=message_id,
                 body={'removeLabelIds': ['UNREAD']}
             ).execute()
-            print(f'Message {message_id} marked as read')
+            logger.debug('Message %s marked as read', message_id)
             return True
         except Exception as e:
-            print(f'Error marking message as read: {e}')
+            self.check_auth_error(e)
+            logger.error('Error marking message as read: %s', e)
             return False
     
+    def batch_mark_as_read(self, message_ids):
+        """Mark messages as read in bulk, returning the IDs that failed"""
+        failed_ids = []
+        for start in range(0, len(message_ids), BULK_SIZE):
+            chunk = message_ids[start:start + BULK_SIZE]
+            try:
+                self.service.users().messages().batchModify(
+                    userId='me',
+                    body={'ids': chunk, 'removeLabelIds': ['UNREAD']}
+                ).execute()
+                logger.debug('%d messages marked as read', len(chunk))
+            except Exception as e:
+                self.check_auth_error(e)
+                logger.error('Error marking messages as read: %s', e)
+                failed_ids.extend(chunk)
+        return failed_ids
+    
     def delete_message(self, message_id):
         """Delete a message"""
         try:
@@ -170,27 +349,41 @@ class GmailClient:
                 userId='me',
                 id=message_id
             ).execute()
-            print(f'Message {message_id} deleted')
+            logger.debug('Message %s deleted', message_id)
             return True
         except Exception as e:
-            print(f'Error deleting message: {e}')
+            self.check_auth_error(e)
+            logger.error('Error deleting message: %s', e)
             return False
     
-    def search_messages(self, sender=None, subject=None, after_date=None, has_attachment=False, is_unread=False):
+    def batch_delete(self, message_ids):
+        """Delete messages in bulk, returning the IDs that failed"""
+        failed_ids = []
+        for start in range(0, len(message_ids), BULK_SIZE):
+            chunk = message_ids[start:start + BULK_SIZE]
+            try:
+                self.service.users().messages().batchDelete(
+                    userId='me',
+                    body={'ids': chunk}
+                ).execute()
+                logger.debug('%d messages deleted', len(chunk))
+            except Exception as e:
+                self.check_auth_error(e)
+                logger.error('Error deleting messages: %s', e)
+                failed_ids.extend(chunk)
+        return failed_ids
+    
+    def search_messages(self, sender=None, subject=None, after_date=None, before_date=None, has_attachment=False, is_unread=False, max_results=10):
         """Search messages with specific criteria"""
-        query_parts = []
-        
-        if sender:
-            query_parts.append(f'from:{sender}')
-        if subject:
-            query_parts.append(f'subject:"{subject}"')
-        if after_date:
-            query_parts.append(f'after:{after_date}')
-        if has_attachment:
-            query_parts.append('has:attachment')
-        if is_unread:
-            query_parts.append('is:unread')
+        query_parts = (
+            f'from:{sender}' if sender else '',
+            f'subject:"{subject}"' if subject else '',
+            f'after:{after_date}' if after_date else '',
+            f'before:{before_date}' if before_date else '',
+            'has:attachment' if has_attachment else '',
+            'is:unread' if is_unread else '',
+        )
         
-        query = ' '.join(query_parts)
-        print(f"Search query: {query}")
-        return self.list_messages(query)
+        query = ' '.join(part for part in query_parts if part)
+        logger.debug("Search query: %s", query)
+        return self.list_messages(query, max_results)
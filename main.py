@@ -5,57 +5,102 @@ This module provides Gmail functionality through Model Context Protocol
 using FastMCP for simplified server setup.
 """
 
+import asyncio
+import functools
+import logging
 import os
-from typing import Any, Dict, List, Optional
+import re
+import threading
+from typing import Any, Awaitable, Callable, Dict, List, Optional
 
 from mcp.server.fastmcp import FastMCP
-from dotenv import load_dotenv
 
 # Import our Gmail authentication and client
-from gmail_auth import authenticate_gmail_with_nango_v2
-from gmail_operations import GmailClient
+from config import ensure_env
+from gmail_auth import (
+    build_gmail_service,
+    get_gmail_credentials,
+    invalidate_credentials,
+    load_gmail_discovery,
+)
+from gmail_operations import GmailClient, SEARCH_HEADERS, SUMMARY_FIELDS, SUMMARY_HEADERS
 
-# Load environment variables
-load_dotenv()
+logger = logging.getLogger("gmail_mcp")
 
 # Initialize FastMCP server
 mcp = FastMCP("Gmail MCP Server")
 
-# Global variables for Gmail connection
-_gmail_client: Optional[GmailClient] = None
-_gmail_service = None
+# Per-thread Gmail clients, since googleapiclient services are not thread-safe
+_local = threading.local()
+
+# Single address with a dotted domain and no whitespace
+_EMAIL_RE = re.compile(r"^[^@\s]+@[^@\s]+\.[^@\s]+$")
 
 
 def get_gmail_client() -> GmailClient:
-    """Get or create the global Gmail client."""
-    global _gmail_client, _gmail_service
+    """Get or create the Gmail client for the current thread.
     
-    if _gmail_client is None:
-        connection_id = os.getenv('NANGO_CONNECTION_ID')
-        provider_config_key = os.getenv('NANGO_INTEGRATION_ID', 'google')
-        
-        if not connection_id:
-            raise ValueError("NANGO_CONNECTION_ID environment variable is required")
-        
-        print(f"Initializing Gmail client with connection: {connection_id}")
-        _gmail_service = authenticate_gmail_with_nango_v2(connection_id, provider_config_key)
-        _gmail_client = GmailClient(_gmail_service)
-        print("Gmail client initialized successfully")
+    Credentials are cached by the auth layer until the access token nears
+    expiry. Each worker thread builds its own service from them, and only
+    rebuilds it when the credentials change.
+    """
+    ensure_env()
+    connection_id = os.getenv('NANGO_CONNECTION_ID')
+    provider_config_key = os.getenv('NANGO_INTEGRATION_ID', 'google')
+    
+    if not connection_id:
+        raise ValueError("NANGO_CONNECTION_ID environment variable is required")
     
-    return _gmail_client
+    creds = get_gmail_credentials(connection_id, provider_config_key)
+    if getattr(_local, 'credentials', None) is not creds:
+        logger.info("Initializing Gmail client with connection: %s", connection_id)
+        _local.credentials = creds
+        _local.client = GmailClient(
+            build_gmail_service(creds),
+            credentials=creds,
+            on_auth_error=functools.partial(invalidate_credentials, connection_id, provider_config_key)
+        )
+        logger.info("Gmail client initialized successfully")
+    
+    return _local.client
+
+
+def run_in_thread(func: Callable[..., Dict[str, Any]]) -> Callable[..., Awaitable[Dict[str, Any]]]:
+    """Expose a blocking tool as a coroutine that runs in a worker thread."""
+    @functools.wraps(func)
+    async def wrapper(*args: Any, **kwargs: Any) -> Dict[str, Any]:
+        return await asyncio.to_thread(func, *args, **kwargs)
+    
+    return wrapper
 
 
 def validate_message_id(message_id: str) -> bool:
     """Validate Gmail message ID format."""
-    return bool(message_id and isinstance(message_id, str) and len(message_id) > 0)
+    return isinstance(message_id, str) and bool(message_id)
 
 
 def validate_email_address(email: str) -> bool:
     """Basic email validation."""
-    return bool(email and '@' in email and '.' in email.split('@')[1])
+    return bool(email and _EMAIL_RE.match(email))
+
+
+def _summarize_message(msg_id: str, message: Dict[str, Any], headers: Dict[str, str]) -> Dict[str, Any]:
+    """Build the summary shown for a message in list and search results."""
+    labels = message.get('labelIds') or []
+    snippet = message.get('snippet') or ''
+    return {
+        'id': msg_id,
+        'from': headers.get('From', 'Unknown'),
+        'subject': headers.get('Subject', 'No Subject'),
+        'date': headers.get('Date', 'Unknown'),
+        'snippet': snippet[:100] + '...' if snippet else '',
+        'labels': labels,
+        'is_unread': 'UNREAD' in labels
+    }
 
 
 @mcp.tool()
+@run_in_thread
 def gmail_list_messages(
     query: str = "",
     max_results: int = 10
@@ -81,21 +126,21 @@ def gmail_list_messages(
         if not messages:
             return {"success": True, "count": 0, "messages": [], "message": "No messages found"}
         
-        # Get detailed info for each message
+        # Get detailed info for all messages in batched requests
+        message_ids = [msg['id'] for msg in messages]
+        fetched = gmail.batch_get_messages(
+            message_ids,
+            format='metadata',
+            metadata_headers=SUMMARY_HEADERS,
+            fields=SUMMARY_FIELDS
+        )
+        
         detailed_messages = []
-        for msg in messages:
-            message = gmail.get_message(msg['id'])
+        for msg_id in message_ids:
+            message = fetched.get(msg_id)
             if message:
                 headers = gmail.get_message_headers(message)
-                detailed_messages.append({
-                    'id': msg['id'],
-                    'from': headers.get('From', 'Unknown'),
-                    'subject': headers.get('Subject', 'No Subject'),
-                    'date': headers.get('Date', 'Unknown'),
-                    'snippet': message.get('snippet', '')[:100] + '...' if message.get('snippet') else '',
-                    'labels': message.get('labelIds', []),
-                    'is_unread': 'UNREAD' in message.get('labelIds', [])
-                })
+                detailed_messages.append(_summarize_message(msg_id, message, headers))
         
         return {
             "success": True,
@@ -109,6 +154,7 @@ def gmail_list_messages(
 
 
 @mcp.tool()
+@run_in_thread
 def gmail_get_message(message_id: str) -> Dict[str, Any]:
     """
     Get details of a specific Gmail message.
@@ -124,7 +170,7 @@ def gmail_get_message(message_id: str) -> Dict[str, Any]:
             return {"success": False, "error": "Invalid message ID provided"}
         
         gmail = get_gmail_client()
-        message = gmail.get_message(message_id)
+        message = gmail.get_message(message_id, format='full')
         
         if not message:
             return {"success": False, "error": f"Message {message_id} not found"}
@@ -153,6 +199,7 @@ def gmail_get_message(message_id: str) -> Dict[str, Any]:
 
 
 @mcp.tool()
+@run_in_thread
 def gmail_send_message(
     to: str,
     subject: str,
@@ -203,6 +250,7 @@ def gmail_send_message(
 
 
 @mcp.tool()
+@run_in_thread
 def gmail_search_messages(
     sender: Optional[str] = None,
     subject: Optional[str] = None,
@@ -237,8 +285,10 @@ def gmail_search_messages(
             sender=sender,
             subject=subject,
             after_date=after_date,
+            before_date=before_date,
             has_attachment=has_attachment,
-            is_unread=is_unread
+            is_unread=is_unread,
+            max_results=max_results
         )
         
         if not messages:
@@ -249,33 +299,34 @@ def gmail_search_messages(
                 "message": "No messages found matching search criteria"
             }
         
-        # Limit results
-        messages = messages[:max_results]
+        # Get detailed info for all messages in batched requests
+        message_ids = [msg['id'] for msg in messages]
+        fetched = gmail.batch_get_messages(
+            message_ids,
+            format='metadata',
+            metadata_headers=SEARCH_HEADERS,
+            fields=SUMMARY_FIELDS
+        )
         
-        # Get detailed info for each message
         detailed_messages = []
-        for msg in messages:
-            message = gmail.get_message(msg['id'])
+        for msg_id in message_ids:
+            message = fetched.get(msg_id)
             if message:
                 headers = gmail.get_message_headers(message)
-                detailed_messages.append({
-                    'id': msg['id'],
-                    'from': headers.get('From', 'Unknown'),
-                    'subject': headers.get('Subject', 'No Subject'),
-                    'date': headers.get('Date', 'Unknown'),
-                    'snippet': message.get('snippet', '')[:100] + '...' if message.get('snippet') else '',
-                    'is_unread': 'UNREAD' in message.get('labelIds', []),
-                    'has_attachment': 'attachment' in (message.get('snippet', '') or '').lower()
-                })
+                summary = _summarize_message(msg_id, message, headers)
+                # Every result already matched has:attachment when it was requested
+                summary['has_attachment'] = has_attachment or gmail.message_has_attachment(message, headers)
+                detailed_messages.append(summary)
         
         # Build search criteria summary
-        criteria = []
-        if sender: criteria.append(f"sender: {sender}")
-        if subject: criteria.append(f"subject: {subject}")
-        if after_date: criteria.append(f"after: {after_date}")
-        if before_date: criteria.append(f"before: {before_date}")
-        if has_attachment: criteria.append("has attachment")
-        if is_unread: criteria.append("unread only")
+        criteria = [c for c in (
+            f"sender: {sender}" if sender else '',
+            f"subject: {subject}" if subject else '',
+            f"after: {after_date}" if after_date else '',
+            f"before: {before_date}" if before_date else '',
+            "has attachment" if has_attachment else '',
+            "unread only" if is_unread else '',
+        ) if c]
         
         return {
             "success": True,
@@ -289,6 +340,7 @@ def gmail_search_messages(
 
 
 @mcp.tool()
+@run_in_thread
 def gmail_mark_as_read(message_ids: List[str]) -> Dict[str, Any]:
     """
     Mark Gmail messages as read.
@@ -303,20 +355,14 @@ def gmail_mark_as_read(message_ids: List[str]) -> Dict[str, Any]:
         if not message_ids:
             return {"success": False, "error": "No message IDs provided"}
         
-        # Validate message IDs
-        invalid_ids = [msg_id for msg_id in message_ids if not validate_message_id(msg_id)]
-        if invalid_ids:
+        # Validate message IDs, only collecting the invalid ones when needed
+        if not all(isinstance(msg_id, str) and msg_id for msg_id in message_ids):
+            invalid_ids = [msg_id for msg_id in message_ids if not validate_message_id(msg_id)]
             return {"success": False, "error": f"Invalid message IDs: {invalid_ids}"}
         
         gmail = get_gmail_client()
-        success_count = 0
-        failed_ids = []
-        
-        for msg_id in message_ids:
-            if gmail.mark_as_read(msg_id):
-                success_count += 1
-            else:
-                failed_ids.append(msg_id)
+        failed_ids = gmail.batch_mark_as_read(message_ids)
+        success_count = len(message_ids) - len(failed_ids)
         
         result = {
             "success": success_count > 0,
@@ -335,6 +381,7 @@ def gmail_mark_as_read(message_ids: List[str]) -> Dict[str, Any]:
 
 
 @mcp.tool()
+@run_in_thread
 def gmail_delete_messages(message_ids: List[str]) -> Dict[str, Any]:
     """
     Delete Gmail messages.
@@ -349,20 +396,14 @@ def gmail_delete_messages(message_ids: List[str]) -> Dict[str, Any]:
         if not message_ids:
             return {"success": False, "error": "No message IDs provided"}
         
-        # Validate message IDs
-        invalid_ids = [msg_id for msg_id in message_ids if not validate_message_id(msg_id)]
-        if invalid_ids:
+        # Validate message IDs, only collecting the invalid ones when needed
+        if not all(isinstance(msg_id, str) and msg_id for msg_id in message_ids):
+            invalid_ids = [msg_id for msg_id in message_ids if not validate_message_id(msg_id)]
             return {"success": False, "error": f"Invalid message IDs: {invalid_ids}"}
         
         gmail = get_gmail_client()
-        success_count = 0
-        failed_ids = []
-        
-        for msg_id in message_ids:
-            if gmail.delete_message(msg_id):
-                success_count += 1
-            else:
-                failed_ids.append(msg_id)
+        failed_ids = gmail.batch_delete(message_ids)
+        success_count = len(message_ids) - len(failed_ids)
         
         result = {
             "success": success_count > 0,
@@ -382,6 +423,7 @@ def gmail_delete_messages(message_ids: List[str]) -> Dict[str, Any]:
 
 
 @mcp.tool()
+@run_in_thread
 def gmail_get_stats(include_unread: bool = True) -> Dict[str, Any]:
     """
     Get Gmail account statistics.
@@ -392,11 +434,15 @@ def gmail_get_stats(include_unread: bool = True) -> Dict[str, Any]:
     Returns:
         Dictionary with account statistics
     """
+    gmail = None
     try:
         gmail = get_gmail_client()
         
         # Get profile information
-        profile = _gmail_service.users().getProfile(userId='me').execute()
+        profile = gmail.service.users().getProfile(
+            userId='me',
+            fields='emailAddress,messagesTotal,threadsTotal,historyId'
+        ).execute()
         
         stats = {
             "success": True,
@@ -408,18 +454,26 @@ def gmail_get_stats(include_unread: bool = True) -> Dict[str, Any]:
         
         if include_unread:
             try:
-                unread_messages = gmail.search_messages(is_unread=True, max_results=100)
-                stats["unread_count"] = len(unread_messages)
+                unread_label = gmail.service.users().labels().get(
+                    userId='me',
+                    id='UNREAD',
+                    fields='messagesUnread,threadsUnread'
+                ).execute()
+                stats["unread_count"] = unread_label.get('messagesUnread', 0)
             except Exception as e:
+                gmail.check_auth_error(e)
                 stats["unread_count"] = f"Error counting unread: {str(e)}"
         
         return stats
         
     except Exception as e:
+        if gmail is not None:
+            gmail.check_auth_error(e)
         return {"success": False, "error": f"Failed to get stats: {str(e)}"}
 
 
 @mcp.tool()
+@run_in_thread
 def gmail_send_message_with_attachment(
     to: str,
     subject: str,
@@ -480,10 +534,15 @@ def gmail_send_message_with_attachment(
 
 def run():
     try:
-        print("Starting Gmail MCP Server...")
+        ensure_env()
+        # FastMCP has already configured the root logger, so set the level on ours
+        logger.setLevel(os.getenv("GMAIL_MCP_LOGLEVEL", "WARNING").upper())
+        logger.info("Starting Gmail MCP Server...")
+        # Parse the discovery document up front so the first tool call doesn't pay for it
+        load_gmail_discovery()
         mcp.run(transport="stdio")
     except KeyboardInterrupt:
-        print("Server stopped by user")
+        logger.info("Server stopped by user")
     except Exception as e:
-        print(f"Server failed to start: {str(e)}")
+        logger.error("Server failed to start: %s", e)
         raise